@@ -2,11 +2,12 @@
 #----> general imports
 import pandas as pd
 import os
+import torch
 from timeit import default_timer as timer
 from datasets.dataset_survival import SurvivalDatasetFactory
 from utils.core_utils import _train_val
 from utils.file_utils import _save_pkl
-from utils.general_utils import _get_start_end, _prepare_for_experiment, _reading_experiment_settings
+from utils.general_utils import _get_start_end, _prepare_for_experiment, _reading_experiment_settings, _init_distributed, _is_main_process
 from utils.valid_utils import _val
 
 from utils.process_args import _process_args
@@ -32,6 +33,9 @@ def main(args):
         log_path = os.path.join(args.results_dir, 'log_test.txt')
     else:
         log_path = os.path.join(args.results_dir, 'log_start_{}_end_{}.txt'.format(args.k_start, args.k_end))
+    if not _is_main_process():
+        # only the main DDP process keeps a log
+        log_path = os.devnull
     log_file = open(log_path, 'w')
 
     for i in folds:
@@ -55,9 +59,14 @@ def main(args):
             #----> train and val
             results, (val_cindex, val_cindex_ipcw, val_BS, val_IBS, val_iauc, total_loss) = _train_val(datasets, i, args,log_file)
             # write results to pkl
-            filename = os.path.join(args.results_dir, 'split_{}_results_final.pkl'.format(i))
-            print("Saving results...")
-            _save_pkl(filename, results)
+            if _is_main_process():
+                filename = os.path.join(args.results_dir, 'split_{}_results_final.pkl'.format(i))
+                print("Saving results...")
+                _save_pkl(filename, results)
+
+        if not _is_main_process():
+            # under DDP the validation metrics only exist on the main process
+            continue
 
         all_val_cindex.append(val_cindex)
         all_val_cindex_ipcw.append(val_cindex_ipcw)
@@ -69,6 +78,9 @@ def main(args):
 
     log_file.close()
 
+    if not _is_main_process():
+        return
+
     final_df = pd.DataFrame({
         'folds': folds,
         'val_cindex': all_val_cindex,
@@ -100,6 +112,15 @@ if __name__ == "__main__":
 
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
     # os.environ["CUDA_LAUNCH_BLOCKING"] = "1"
+    # limit caching allocator fragmentation from the variable WSI bag sizes, has to be set before the first CUDA allocation
+    # expandable_segments only exists from torch 2.1, older allocators reject unknown options
+    alloc_conf = "max_split_size_mb:256,garbage_collection_threshold:0.8"
+    if torch.__version__ >= "2.1":
+        alloc_conf = "expandable_segments:True," + alloc_conf
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", alloc_conf)
+
+    #----> DDP when launched with torchrun, e.g. torchrun --nproc_per_node 2 main.py --gpu 0,1
+    args = _init_distributed(args)
 
     #----> prep
     args = _prepare_for_experiment(args)
@@ -123,6 +144,9 @@ if __name__ == "__main__":
 
     results = main(args)
 
+    if args.distributed:
+        torch.distributed.destroy_process_group()
+
     #---> stop timer and print
     end = timer()
     print("finished!")
@@ -1,6 +1,8 @@
-from ast import Lambda
+import contextlib
+import inspect
 import numpy as np
 import os
+from custom_optims.lamb import Lamb
 from custom_optims.radam import RAdam
 from models.model_PIBD import PIBD
 from sksurv.metrics import concordance_index_censored, concordance_index_ipcw, brier_score, integrated_brier_score, cumulative_dynamic_auc
@@ -9,8 +11,10 @@ from utils.file_utils import _save_pkl
 
 #----> pytorch imports
 import torch
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 
-from utils.general_utils import _get_split_loader, _print_network, _save_splits
+from utils.general_utils import _get_split_loader, _print_network, _save_splits, _is_main_process
 from utils.loss_func import NLLSurvLoss,SurvPLE, RankLoss
 
 import torch.optim as optim
@@ -35,7 +39,8 @@ def _get_splits(datasets, cur, args):
     print('\nTraining Fold {}!'.format(cur))
     print('\nInit train/val splits...', end=' ')
     train_split, val_split = datasets
-    _save_splits(datasets, ['train', 'val'], os.path.join(args.results_dir, 'splits_{}.csv'.format(cur)))
+    if _is_main_process():
+        _save_splits(datasets, ['train', 'val'], os.path.join(args.results_dir, 'splits_{}.csv'.format(cur)))
     print('Done!')
     print("Training on {} samples".format(len(train_split)))
     print("Validating on {} samples".format(len(val_split)))
@@ -66,6 +71,22 @@ def _init_loss_function(args):
     print('Done!')
     return loss_fn
 
+def _fused_kwargs(optimizer_cls, model):
+    r"""
+    Ask for the fused (single kernel) implementation of a torch optimizer when this torch version
+    and the device of the parameters support it
+
+    Args:
+        - optimizer_cls : torch optim class
+        - model : torch model
+
+    Returns:
+        - kwargs : dict
+    """
+    if 'fused' in inspect.signature(optimizer_cls).parameters and next(model.parameters()).is_cuda:
+        return {'fused': True}
+    return {}
+
 def _init_optim(args, model):
     r"""
     Init the optimizer 
@@ -80,15 +101,15 @@ def _init_optim(args, model):
     print('\nInit optimizer ...', end=' ')
 
     if args.opt == "adam":
-        optimizer = optim.Adam(model.parameters(), lr=args.lr)
+        optimizer = optim.Adam(model.parameters(), lr=args.lr, **_fused_kwargs(optim.Adam, model))
     elif args.opt == 'sgd':
         optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=0.9, weight_decay=args.reg)
     elif args.opt == "adamW":
-        optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.reg)
+        optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.reg, **_fused_kwargs(optim.AdamW, model))
     elif args.opt == "radam":
         optimizer = RAdam(model.parameters(), lr=args.lr, weight_decay=args.reg)
     elif args.opt == "lamb":
-        optimizer = Lambda(model.parameters(), lr=args.lr, weight_decay=args.reg)
+        optimizer = Lamb(model.parameters(), lr=args.lr, weight_decay=args.reg)
     else:
         raise NotImplementedError
 
@@ -130,12 +151,42 @@ def _init_model(args):
 
     if torch.cuda.is_available():
         model = model.to(torch.device('cuda'))
+        if args.channels_last:
+            # only 4D parameters (conv weights) change layout, linear layers are left as they are
+            model = model.to(memory_format=torch.channels_last)
+
+    if args.distributed:
+        model = DistributedDataParallel(model, device_ids=[args.local_rank], gradient_as_bucket_view=True, static_graph=True)
+
+    if args.compile and hasattr(torch, "compile"):
+        # dynamic shapes since the number of WSI patches differs between the train and val bags. Default mode, as
+        # 'reduce-overhead' adds CUDA graphs: PIBD's random bag sampling cannot be captured and every validation
+        # bag length would record its own graph
+        model = torch.compile(model, fullgraph=False, dynamic=True)
+        _compile_risk_kernel()
 
     print('Done!')
-    _print_network(args.results_dir, model)
+    if _is_main_process():
+        _print_network(args.results_dir, model)
 
     return model
 
+def _unwrap_model(model):
+    r"""
+    Return the underlying model, so state dicts are saved and loaded without the torch.compile "_orig_mod."
+    and DDP "module." prefixes
+
+    Args:
+        - model : torch model
+
+    Returns:
+        - model : torch model
+    """
+    model = getattr(model, "_orig_mod", model)
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    return model
+
 def _init_loaders(args, train_split, val_split):
     r"""
     Init dataloaders for the train and val datasets 
@@ -153,7 +204,11 @@ def _init_loaders(args, train_split, val_split):
 
     print('\nInit Loaders...', end=' ')
     if train_split:
-        train_loader = _get_split_loader(args, train_split, training=True, testing=False, weighted=args.weighted_sample, batch_size=args.batch_size)
+        # each DDP process trains on its own shard, weighted sampling is not supported in that case
+        train_sampler = DistributedSampler(train_split, shuffle=True) if args.distributed else None
+        if train_sampler is not None and args.weighted_sample and _is_main_process():
+            print('\nWarning: --weighted_sample is ignored with DDP, every process samples its shard uniformly')
+        train_loader = _get_split_loader(args, train_split, training=True, testing=False, weighted=args.weighted_sample, batch_size=args.batch_size, sampler=train_sampler)
     else:
         train_loader = None
 
@@ -180,20 +235,127 @@ def _extract_survival_metadata(train_loader, val_loader):
     
     """
 
-    all_censorships = np.concatenate(
-        [train_loader.dataset.metadata[train_loader.dataset.censorship_var].to_numpy(),
-        val_loader.dataset.metadata[val_loader.dataset.censorship_var].to_numpy()],
-        axis=0)
+    all_censorships = _concat_columns(train_loader.dataset.metadata[train_loader.dataset.censorship_var],
+                                      val_loader.dataset.metadata[val_loader.dataset.censorship_var])
+    all_event_times = _concat_columns(train_loader.dataset.metadata[train_loader.dataset.label_col],
+                                      val_loader.dataset.metadata[val_loader.dataset.label_col])
 
-    all_event_times = np.concatenate(
-        [train_loader.dataset.metadata[train_loader.dataset.label_col].to_numpy(),
-        val_loader.dataset.metadata[val_loader.dataset.label_col].to_numpy()],
-        axis=0)
-
-    all_survival = Surv.from_arrays(event=(1-all_censorships).astype(bool), time=all_event_times)
+    event_bool = (1-all_censorships).astype(bool)
+    all_survival = Surv.from_arrays(event=event_bool, time=all_event_times)
     return all_survival
 
-def _unpack_data(omics_format, device, data):
+def _concat_columns(train_column, val_column):
+    r"""
+    Copy the train and val metadata columns straight into one preallocated array
+
+    Args:
+        - train_column : pd.Series
+        - val_column : pd.Series
+
+    Returns:
+        - column : np.array
+
+    """
+    train_values, val_values = train_column.values, val_column.values
+    column = np.empty(train_values.size + val_values.size, dtype=np.result_type(train_values, val_values))
+    column[:train_values.size] = train_values
+    column[train_values.size:] = val_values
+    return column
+
+def _mark_dynamic_bag(model, data_WSI):
+    r"""
+    Tell torch.compile that the bag dimension of the WSI tensor varies, so new bag lengths do not trigger a recompile
+
+    Args:
+        - model : torch model
+        - data_WSI : torch.Tensor
+
+    Returns:
+        - None
+    """
+    if hasattr(model, "_orig_mod") and data_WSI.dim() > 1:
+        torch._dynamo.mark_dynamic(data_WSI, 1)
+
+def _batch_to_device(data, device):
+    r"""
+    Recursively move every tensor of a collated batch to the device, leaving non-tensor entries untouched
+
+    Args:
+        - data : tensor, list, tuple or any other object
+        - device : torch.device
+
+    Returns:
+        - data : same structure as the input, with tensors on the device
+
+    """
+    if isinstance(data, torch.Tensor):
+        return data.to(device, non_blocking=True)
+    elif isinstance(data, list):
+        return [_batch_to_device(item, device) for item in data]
+    elif isinstance(data, tuple):
+        return tuple(_batch_to_device(item, device) for item in data)
+    return data
+
+def _batch_tensors(data):
+    r"""
+    Recursively collect the tensors of a collated batch
+
+    Args:
+        - data : tensor, list, tuple or any other object
+
+    Returns:
+        - tensors : List
+
+    """
+    if isinstance(data, torch.Tensor):
+        return [data]
+    elif isinstance(data, (list, tuple)):
+        return [tensor for item in data for tensor in _batch_tensors(item)]
+    return []
+
+class _Prefetcher:
+    r"""
+    Wrap a dataloader and copy the next batch to the GPU on a side stream while the current batch is being processed.
+    On CPU the batches are returned as they come out of the loader.
+
+    Args:
+        - loader : Pytorch dataloader
+        - device : torch.device
+
+    """
+    def __init__(self, loader, device):
+        self.loader_iter = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream() if device.type == "cuda" else None
+        self.preload()
+
+    def preload(self):
+        try:
+            self.batch = next(self.loader_iter)
+        except StopIteration:
+            self.batch = None
+            return
+
+        if self.stream is not None:
+            with torch.cuda.stream(self.stream):
+                self.batch = _batch_to_device(self.batch, self.device)
+
+    def next(self):
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            # the tensors were allocated on the side stream, tell the allocator they are used on the current one
+            for tensor in _batch_tensors(self.batch):
+                tensor.record_stream(torch.cuda.current_stream())
+        batch = self.batch
+        if batch is not None:
+            self.preload()
+        return batch
+
+    def __iter__(self):
+        while (batch := self.next()) is not None:
+            yield batch
+
+def _unpack_data(omics_format, device, data, channels_last=False):
     r"""
     Depending on the model type, unpack the data and put it on the correct device
     
@@ -201,6 +363,7 @@ def _unpack_data(omics_format, device, data):
         - omics_format : String
         - device : torch.device 
         - data : tuple 
+        - channels_last : Boolean
     
     Returns:
         - data_WSI : torch.Tensor
@@ -210,58 +373,54 @@ def _unpack_data(omics_format, device, data):
         - censor : torch.Tensor
         - data_omics : torch.Tensor
         - clinical_data_list : list
-        - mask : torch.Tensor
     
     """
     # prepare wsi data
-    data_WSI = data[0].to(device)
+    data_WSI = data[0].to(device, non_blocking=True)
+    if channels_last and data_WSI.dim() == 4:
+        data_WSI = data_WSI.contiguous(memory_format=torch.channels_last)
 
     # prepare omics data
     if omics_format == "gene":
         mask = None
-        data_omics = data[1].to(device)
+        data_omics = data[1].to(device, non_blocking=True)
         y_disc, event_time, censor, clinical_data_list = data[2], data[3], data[4], data[5]
 
     elif omics_format == "groups":
 
-        data_omic1 = data[1].type(torch.FloatTensor).to(device)
-        data_omic2 = data[2].type(torch.FloatTensor).to(device)
-        data_omic3 = data[3].type(torch.FloatTensor).to(device)
-        data_omic4 = data[4].type(torch.FloatTensor).to(device)
-        data_omic5 = data[5].type(torch.FloatTensor).to(device)
-        data_omic6 = data[6].type(torch.FloatTensor).to(device)
+        data_omic1 = data[1].to(device=device, dtype=torch.float32, non_blocking=True)
+        data_omic2 = data[2].to(device=device, dtype=torch.float32, non_blocking=True)
+        data_omic3 = data[3].to(device=device, dtype=torch.float32, non_blocking=True)
+        data_omic4 = data[4].to(device=device, dtype=torch.float32, non_blocking=True)
+        data_omic5 = data[5].to(device=device, dtype=torch.float32, non_blocking=True)
+        data_omic6 = data[6].to(device=device, dtype=torch.float32, non_blocking=True)
         data_omics = [data_omic1, data_omic2, data_omic3, data_omic4, data_omic5, data_omic6]
 
         y_disc, event_time, censor, clinical_data_list, mask = data[7], data[8], data[9], data[10], data[11]
-        mask = mask.to(device)
+        mask = mask.to(device, non_blocking=True)
 
     elif omics_format == "pathways":
 
-        data_omics = []
-        for idx,item in enumerate(data[1]):
-            for idy,omic in enumerate(item):
-                omic = omic.to(device)
-                omic = omic.unsqueeze(0)
-                if idx == 0:
-                    data_omics.append(omic)
-                else:
-                    data_omics[idy] = torch.cat((data_omics[idy],omic),dim=0)
-        
-        if data[6][0,0] == 1:
-            mask = None
-        else:
-            mask = data[6].to(device)
+        # the collate function already stacks each pathway over the batch
+        data_omics = [omic.to(device, non_blocking=True) for omic in data[1]]
+
+        # None when the collate function found no mask in the batch
+        mask = data[6]
+        if mask is not None:
+            mask = mask.to(device, non_blocking=True)
 
         y_disc, event_time, censor, clinical_data_list = data[2], data[3], data[4], data[5]
         
     else:
         raise ValueError('Unsupported omics type:', omics_format)
     
-    y_disc, event_time, censor = y_disc.to(device), event_time.to(device), censor.to(device)
+    y_disc = y_disc.to(device, non_blocking=True)
+    event_time = event_time.to(device, non_blocking=True)
+    censor = censor.to(device, non_blocking=True)
 
-    return data_WSI, mask, y_disc, event_time, censor, data_omics, clinical_data_list, mask
+    return data_WSI, mask, y_disc, event_time, censor, data_omics, clinical_data_list
 
-def _process_data_and_forward(model, omics_format, device, data):
+def _process_data_and_forward(model, omics_format, device, data, channels_last=False):
     r"""
     Depeding on the omics farmat, process the input data and do a forward pass on the model
     
@@ -270,6 +429,7 @@ def _process_data_and_forward(model, omics_format, device, data):
         - omics_format : String
         - device : torch.device
         - data : tuple
+        - channels_last : Boolean
     
     Returns:
         - out : torch.Tensor
@@ -279,23 +439,22 @@ def _process_data_and_forward(model, omics_format, device, data):
         - clinical_data_list : List
     
     """
-    data_WSI, mask, y_disc, event_time, censor, data_omics, clinical_data_list, mask = _unpack_data(omics_format, device, data)
+    data_WSI, mask, y_disc, event_time, censor, data_omics, clinical_data_list = _unpack_data(omics_format, device, data, channels_last)
+    _mark_dynamic_bag(model, data_WSI)
 
-    input_args = {"x_wsi": data_WSI.to(device)}
-    input_args["return_attn"] = False
-    input_args["y"] = y_disc
-    input_args["c"] = censor
+    # everything is already on the device with the right dtype after _unpack_data
+    input_args = {"x_wsi": data_WSI, "return_attn": False, "y": y_disc, "c": censor, "mask": mask}
 
     if omics_format == "gene":
 
-        input_args["x_omics"] = data_omics.to(device)
+        input_args["x_omics"] = data_omics
         
         out = model(**input_args)
 
     elif omics_format in ["groups", "pathways"]:
 
         for i in range(len(data_omics)):
-            input_args['x_omic%s' % str(i+1)] = data_omics[i].type(torch.FloatTensor).to(device)
+            input_args['x_omic%s' % str(i+1)] = data_omics[i]
 
         out = model(**input_args)
 
@@ -305,6 +464,37 @@ def _process_data_and_forward(model, omics_format, device, data):
     return out, y_disc, event_time, censor, clinical_data_list
 
 
+def _risk_kernel(h):
+    r"""
+    Survival curve and risk from the logits, computed in log-space so the whole reduction can be fused
+    log(1 - sigmoid(h)) = logsigmoid(-h), so the cumulative product of (1 - hazards) becomes a cumulative sum
+
+    Args:
+        - h : torch.Tensor
+
+    Returns:
+        - risk : torch.Tensor
+        - survival : torch.Tensor
+
+    """
+    log_survival = torch.cumsum(torch.nn.functional.logsigmoid(-h), dim=1)
+    survival = torch.exp(log_survival)
+    risk = -survival.sum(dim=1)
+    return risk, survival
+
+# eager by default, _init_model swaps in the compiled kernel when --compile is set
+_risk_fn = _risk_kernel
+
+def _compile_risk_kernel():
+    r"""
+    Compile the risk kernel, only called with --compile (torch.compile is available from torch 2.0)
+
+    Returns:
+        - None
+    """
+    global _risk_fn
+    _risk_fn = torch.compile(_risk_kernel, fullgraph=True, dynamic=True)
+
 def _calculate_risk(h):
     r"""
     Take the logits of the model and calculate the risk for the patient 
@@ -314,41 +504,60 @@ def _calculate_risk(h):
     
     Returns:
         - risk : torch.Tensor 
+        - survival : torch.Tensor
     
     """
-    hazards = torch.sigmoid(h)
-    survival = torch.cumprod(1 - hazards, dim=1)
-    risk = -torch.sum(survival, dim=1).detach().cpu().numpy()
-    return risk, survival.detach().cpu().numpy()
+    # keep the survival curve in float32 even when the logits come out of autocast
+    risk, survival = _risk_fn(h.detach().float())
+
+    # stay on the device, the caller moves everything to the cpu once at the end of the epoch
+    return risk, survival
 
-def _update_arrays(all_risk_scores, all_censorships, all_event_times, all_clinical_data, event_time, censor, risk, clinical_data_list):
+def _update_arrays(all_risk_scores, all_censorships, all_event_times, all_clinical_data, event_time, censor, risk, clinical_data_list, start):
     r"""
-    Update the arrays with new values 
+    Update the arrays with new values. The arrays are preallocated on the device and the batch is written
+    at rows [start, start + batch_size), they are moved to the cpu once by _arrays_to_numpy
     
     Args:
-        - all_risk_scores : List
-        - all_censorships : List
-        - all_event_times : List
+        - all_risk_scores : torch.Tensor
+        - all_censorships : torch.Tensor
+        - all_event_times : torch.Tensor
         - all_clinical_data : List
         - event_time : torch.Tensor
         - censor : torch.Tensor
         - risk : torch.Tensor
         - clinical_data_list : List
+        - start : Int
     
     Returns:
-        - all_risk_scores : List
-        - all_censorships : List
-        - all_event_times : List
+        - all_risk_scores : torch.Tensor
+        - all_censorships : torch.Tensor
+        - all_event_times : torch.Tensor
         - all_clinical_data : List
     
     """
-    all_risk_scores.append(risk)
-    all_censorships.append(censor.detach().cpu().numpy())
-    all_event_times.append(event_time.detach().cpu().numpy())
-    all_clinical_data.append(clinical_data_list)
+    end = start + risk.shape[0]
+    all_risk_scores[start:end] = risk
+    all_censorships[start:end] = censor.detach()
+    all_event_times[start:end] = event_time.detach()
+    # one entry per patient, each patient keeps its clinical data wrapped in a list
+    all_clinical_data.extend([clinical_data] for clinical_data in clinical_data_list)
     return all_risk_scores, all_censorships, all_event_times, all_clinical_data
 
-def _train_loop_survival(args, epoch, model, omics_format, loader, optimizer, loss_fn, log_file):
+def _arrays_to_numpy(*arrays):
+    r"""
+    Move the accumulated tensors to the cpu, one transfer per tensor
+
+    Args:
+        - arrays : torch.Tensor
+
+    Returns:
+        - np.array for every input tensor
+
+    """
+    return tuple(array.cpu().numpy() for array in arrays)
+
+def _train_loop_survival(args, epoch, model, omics_format, loader, optimizer, loss_fn, log_file, scaler=None):
     r"""
     Perform one epoch of training 
 
@@ -361,6 +570,7 @@ def _train_loop_survival(args, epoch, model, omics_format, loader, optimizer, lo
         - optimizer : torch.optim
         - loss_fn : custom loss function class
         - log_file : File
+        - scaler : torch.cuda.amp.GradScaler
     
     Returns:
         - c_index : Float
@@ -370,48 +580,81 @@ def _train_loop_survival(args, epoch, model, omics_format, loader, optimizer, lo
     device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model.train()
 
+    if isinstance(loader.sampler, DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+    amp = args.amp and device.type == "cuda"
+    if scaler is None:
+        scaler = torch.cuda.amp.GradScaler(enabled=amp)
+
     total_loss = 0.
-    
-    all_risk_scores = []
-    all_censorships = []
-    all_event_times = []
+
+    num_samples = len(loader.sampler)
+    all_risk_scores = torch.empty(num_samples, device=device)
+    all_censorships = torch.empty(num_samples, device=device)
+    all_event_times = torch.empty(num_samples, device=device)
     all_clinical_data = []
+    start = 0
+
+    # DDP wrapped by torch.compile still exposes no_sync through the original module
+    ddp_model = getattr(model, "_orig_mod", model)
+    num_batches = len(loader)
+
+    optimizer.zero_grad(set_to_none=True)
 
     # one epoch
-    for batch_idx, data in enumerate(loader):
+    for batch_idx, data in enumerate(_Prefetcher(loader, device)):
+
+        # accumulate the gradients of args.accum_steps batches, the allreduce is only needed on the step
+        step = (batch_idx + 1) % args.accum_steps == 0 or batch_idx + 1 == num_batches
+        # the last window of the epoch can hold fewer than args.accum_steps batches
+        window_size = min(args.accum_steps, num_batches - (batch_idx - batch_idx % args.accum_steps))
+        if isinstance(ddp_model, DistributedDataParallel) and not step:
+            sync_context = ddp_model.no_sync()
+        else:
+            sync_context = contextlib.nullcontext()
 
-        h, y_disc, event_time, censor, clinical_data_list = _process_data_and_forward(model, omics_format, device, data)
+        with sync_context:
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=amp):
+                h, y_disc, event_time, censor, clinical_data_list = _process_data_and_forward(model, omics_format, device, data, args.channels_last)
 
 
-        logits, IB_loss_proxy, proxy_loss, mimin_total, mimin_loss_total = h[0], h[1], h[2], h[3], h[4]
+                logits, IB_loss_proxy, proxy_loss, mimin_total, mimin_loss_total = h[0], h[1], h[2], h[3], h[4]
 
-        loss_surv = loss_fn(h=logits, y=y_disc, t=event_time, c=censor)
+                loss_surv = loss_fn(h=logits, y=y_disc, t=event_time, c=censor)
 
-        loss = loss_surv + args.gamma * proxy_loss + IB_loss_proxy + args.sigma * (mimin_total + mimin_loss_total)
-        # print("loss_surv:{},proxy_loss:{},IB_loss_proxy:{}".format(loss_surv.item(),proxy_loss.item(),IB_loss_proxy.item()))
-        h = logits
+                loss = loss_surv + args.gamma * proxy_loss + IB_loss_proxy + args.sigma * (mimin_total + mimin_loss_total)
+            # print("loss_surv:{},proxy_loss:{},IB_loss_proxy:{}".format(loss_surv.item(),proxy_loss.item(),IB_loss_proxy.item()))
+            h = logits
+
+            loss_value = loss.detach()
+            loss = loss / y_disc.shape[0]
+
+            scaler.scale(loss / window_size).backward()
 
-        loss_value = loss.item()
-        loss = loss / y_disc.shape[0]
-        
         risk, _ = _calculate_risk(h)
 
-        all_risk_scores, all_censorships, all_event_times, all_clinical_data = _update_arrays(all_risk_scores, all_censorships, all_event_times,all_clinical_data, event_time, censor, risk, clinical_data_list)
+        all_risk_scores, all_censorships, all_event_times, all_clinical_data = _update_arrays(all_risk_scores, all_censorships, all_event_times,all_clinical_data, event_time, censor, risk, clinical_data_list, start)
+        start += risk.shape[0]
 
         total_loss += loss_value
 
-        loss.backward()
-        optimizer.step()
-        optimizer.zero_grad()
+        if step:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
 
-        if (batch_idx % 1) == 0:
-            print("batch: {}, loss: {:.3f}".format(batch_idx, loss.item()))
-            log_file.write("batch: {}, loss: {:.3f}\n".format(batch_idx, loss.item()))
+        # .item() blocks on the stream, only pay for it on the logged batches
+        if batch_idx % args.log_interval == 0:
+            batch_loss = loss.item()
+            print("batch: {}, loss: {:.3f}".format(batch_idx, batch_loss))
+            log_file.write("batch: {}, loss: {:.3f}\n".format(batch_idx, batch_loss))
     
-    total_loss /= len(loader.dataset)
-    all_risk_scores = np.concatenate(all_risk_scores, axis=0)
-    all_censorships = np.concatenate(all_censorships, axis=0)
-    all_event_times = np.concatenate(all_event_times, axis=0)
+    # under DDP the loss is summed over this process's shard only
+    total_loss = float(total_loss) / len(loader.sampler)
+    all_risk_scores, all_censorships, all_event_times = _arrays_to_numpy(all_risk_scores[:start], all_censorships[:start], all_event_times[:start])
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
     c_index = concordance_index_censored((1-all_censorships).astype(bool), all_event_times, all_risk_scores, tied_tol=1e-08)[0]
 
     print('Epoch: {}, train_loss: {:.4f}, train_c_index: {:.4f}'.format(epoch, total_loss, c_index))
@@ -448,18 +691,20 @@ def _calculate_metrics(loader, dataset_factory, survival_train, all_risk_scores,
     which_times_to_eval_at = np.array([data.min() + 0.0001, bins_original[1], bins_original[2], data.max() - 0.0001])
 
     #---> delete the nans and corresponding elements from other arrays 
-    original_risk_scores = all_risk_scores
-    all_risk_scores = np.delete(all_risk_scores, np.argwhere(np.isnan(original_risk_scores)))
-    all_censorships = np.delete(all_censorships, np.argwhere(np.isnan(original_risk_scores)))
-    all_event_times = np.delete(all_event_times, np.argwhere(np.isnan(original_risk_scores)))
+    keep = ~np.isnan(all_risk_scores)
+    all_risk_scores = all_risk_scores[keep]
+    all_censorships = all_censorships[keep]
+    all_event_times = all_event_times[keep]
+    all_risk_by_bin_scores = all_risk_by_bin_scores[keep]
     #<---
 
-    c_index = concordance_index_censored((1-all_censorships).astype(bool), all_event_times, all_risk_scores, tied_tol=1e-08)[0]
+    event_bool = (1-all_censorships).astype(bool)
+    c_index = concordance_index_censored(event_bool, all_event_times, all_risk_scores, tied_tol=1e-08)[0]
     c_index_ipcw, BS, IBS, iauc = 0., 0., 0., 0.
 
     # change the datatype of survival test to calculate metrics 
     try:
-        survival_test = Surv.from_arrays(event=(1-all_censorships).astype(bool), time=all_event_times)
+        survival_test = Surv.from_arrays(event=event_bool, time=all_event_times)
     except:
         print("Problem converting survival test datatype, so all metrics 0.")
         return c_index, c_index_ipcw, BS, IBS, iauc
@@ -495,25 +740,42 @@ def _calculate_metrics(loader, dataset_factory, survival_train, all_risk_scores,
     return c_index, c_index_ipcw, BS, IBS, iauc
 
 
-def _summary(dataset_factory, model, omics_format, loader, loss_fn, survival_train=None,miss=None):
+def _calculate_cindex(all_risk_scores, all_censorships, all_event_times):
     r"""
-    Run a validation loop on the trained model 
+    Calculate only the c-index, which is cheap enough to be computed after every epoch
+
+    Args:
+        - all_risk_scores : np.array
+        - all_censorships : np.array
+        - all_event_times : np.array
+
+    Returns:
+        - c_index : Float
+
+    """
+    keep = ~np.isnan(all_risk_scores)
+    c_index = concordance_index_censored((1-all_censorships[keep]).astype(bool), all_event_times[keep], all_risk_scores[keep], tied_tol=1e-08)[0]
+    return c_index
+
+def _summary_forward(model, omics_format, loader, loss_fn, miss=None, amp=False, channels_last=False):
+    r"""
+    Run the forward pass of the validation loop and collect the per-patient outputs
     
     Args:
-        - dataset_factory : SurvivalDatasetFactory
         - model : Pytorch model
         - omics_format : String
         - loader : Pytorch loader
         - loss_fn : custom loss function clas
-        - survival_train : np.array
+        - miss : String
+        - amp : Boolean
+        - channels_last : Boolean
     
     Returns:
         - patient_results : dictionary
-        - c_index : Float
-        - c_index_ipcw : Float
-        - BS : List
-        - IBS : Float
-        - iauc : Float
+        - all_risk_scores : np.array
+        - all_censorships : np.array
+        - all_event_times : np.array
+        - all_risk_by_bin_scores : np.array
         - total_loss : Float
 
     """
@@ -522,70 +784,75 @@ def _summary(dataset_factory, model, omics_format, loader, loss_fn, survival_tra
 
     total_loss = 0.
 
-    all_risk_scores = []
-    all_risk_by_bin_scores = []
-    all_censorships = []
-    all_event_times = []
+    num_samples = len(loader.sampler)
+    all_risk_scores = torch.empty(num_samples, device=device)
+    all_censorships = torch.empty(num_samples, device=device)
+    all_event_times = torch.empty(num_samples, device=device)
+    # the number of bins is only known once the model has produced logits
+    all_risk_by_bin_scores = None
+    all_logits = None
     all_clinical_data = []
-    all_logits = []
     all_slide_ids = []
+    start = 0
 
     slide_ids = loader.dataset.metadata['slide_id']
     count = 0
     with torch.no_grad():
 
-        for data in loader:
+        for data in _Prefetcher(loader, device):
 
-            data_WSI, mask, y_disc, event_time, censor, data_omics, clinical_data_list, mask = _unpack_data(omics_format, device, data)
+            data_WSI, mask, y_disc, event_time, censor, data_omics, clinical_data_list = _unpack_data(omics_format, device, data, channels_last)
 
             if miss=="P":
-                data_WSI = torch.zeros_like(data_WSI).to(device)
+                data_WSI = torch.zeros_like(data_WSI)
             if miss=="G":
                 if isinstance(data_omics, list):
                     # 如果 data_omics 是 list，则需要逐个 tensor 处理
-                    data_omics = [torch.zeros_like(omic).to(device) for omic in data_omics]
+                    data_omics = [torch.zeros_like(omic) for omic in data_omics]
                 else:
                     # 否则直接转换
-                    data_omics = torch.zeros_like(data_omics).to(device)
-            input_args = {"x_wsi": data_WSI.to(device)}
-            input_args["return_attn"] = False
-            input_args["y"] = None
-            input_args["c"] = None
+                    data_omics = torch.zeros_like(data_omics)
+            _mark_dynamic_bag(model, data_WSI)
+            input_args = {"x_wsi": data_WSI, "return_attn": False, "y": None, "c": None, "mask": mask}
 
             if omics_format == "gene":
 
-                input_args["x_omics"] = data_omics.to(device)
+                input_args["x_omics"] = data_omics
 
             elif omics_format in ["groups", "pathways"]:
 
                 for i in range(len(data_omics)):
-                    input_args['x_omic%s' % str(i + 1)] = data_omics[i].type(torch.FloatTensor).to(device)
+                    input_args['x_omic%s' % str(i + 1)] = data_omics[i]
 
             else:
                 raise NotImplementedError
 
-            h, _, _, _, _ = model(**input_args)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=amp and device.type == "cuda"):
+                h, _, _, _, _ = model(**input_args)
 
 
-            # loss_value = 0.0
-            if len(h.shape) == 1:
-                h = h.unsqueeze(0)
-            loss_value = loss_fn(h=h, y=y_disc, t=event_time, c=censor)
+                # loss_value = 0.0
+                if len(h.shape) == 1:
+                    h = h.unsqueeze(0)
+                loss_value = loss_fn(h=h, y=y_disc, t=event_time, c=censor)
 
             risk, risk_by_bin = _calculate_risk(h)
-            all_risk_by_bin_scores.append(risk_by_bin)
-            all_risk_scores, all_censorships, all_event_times, clinical_data_list = _update_arrays(all_risk_scores, all_censorships, all_event_times,all_clinical_data, event_time, censor, risk, clinical_data_list)
-            all_logits.append(h.detach().cpu().numpy())
-            total_loss += loss_value
-            all_slide_ids.append(slide_ids.values[count])
-            count += 1
+            if all_logits is None:
+                all_risk_by_bin_scores = torch.empty((num_samples, h.shape[1]), device=device)
+                all_logits = torch.empty((num_samples, h.shape[1]), device=device)
+            all_risk_by_bin_scores[start:start + h.shape[0]] = risk_by_bin
+            all_logits[start:start + h.shape[0]] = h.detach()
+            all_risk_scores, all_censorships, all_event_times, clinical_data_list = _update_arrays(all_risk_scores, all_censorships, all_event_times,all_clinical_data, event_time, censor, risk, clinical_data_list, start)
+            start += h.shape[0]
+            total_loss += loss_value.detach()
+            all_slide_ids.extend(slide_ids.values[count:count + h.shape[0]])
+            count += h.shape[0]
 
     total_loss /= len(loader.dataset)
-    all_risk_scores = np.concatenate(all_risk_scores, axis=0)
-    all_risk_by_bin_scores = np.concatenate(all_risk_by_bin_scores, axis=0)
-    all_censorships = np.concatenate(all_censorships, axis=0)
-    all_event_times = np.concatenate(all_event_times, axis=0)
-    all_logits = np.concatenate(all_logits, axis=0)
+    all_risk_scores, all_risk_by_bin_scores, all_censorships, all_event_times, all_logits = _arrays_to_numpy(
+        all_risk_scores[:start], all_risk_by_bin_scores[:start], all_censorships[:start], all_event_times[:start], all_logits[:start])
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
     
     patient_results = {}
     for i in range(len(all_slide_ids)):
@@ -597,7 +864,37 @@ def _summary(dataset_factory, model, omics_format, loader, loss_fn, survival_tra
         patient_results[case_id]["censorship"] = all_censorships[i]
         patient_results[case_id]["clinical"] = all_clinical_data[i]
         patient_results[case_id]["logits"] = all_logits[i]
+
+    return patient_results, all_risk_scores, all_censorships, all_event_times, all_risk_by_bin_scores, total_loss
+
+def _summary(dataset_factory, model, omics_format, loader, loss_fn, survival_train=None,miss=None, amp=False, channels_last=False):
+    r"""
+    Run a validation loop on the trained model 
+    
+    Args:
+        - dataset_factory : SurvivalDatasetFactory
+        - model : Pytorch model
+        - omics_format : String
+        - loader : Pytorch loader
+        - loss_fn : custom loss function clas
+        - survival_train : np.array
+        - miss : String
+        - amp : Boolean
+        - channels_last : Boolean
     
+    Returns:
+        - patient_results : dictionary
+        - c_index : Float
+        - c_index_ipcw : Float
+        - BS : List
+        - IBS : Float
+        - iauc : Float
+        - total_loss : Float
+
+    """
+    patient_results, all_risk_scores, all_censorships, all_event_times, all_risk_by_bin_scores, total_loss = _summary_forward(
+        model, omics_format, loader, loss_fn, miss, amp, channels_last)
+
     c_index, c_index2, BS, IBS, iauc = _calculate_metrics(loader, dataset_factory, survival_train, all_risk_scores, all_censorships, all_event_times, all_risk_by_bin_scores)
 
     return patient_results, c_index, c_index2, BS, IBS, iauc, total_loss
@@ -645,39 +942,71 @@ def _step(cur, args, loss_fn, model, optimizer, train_loader, val_loader, log_fi
 
 
     all_survival = _extract_survival_metadata(train_loader, val_loader)
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp and torch.cuda.is_available())
+
+    # the val loader is not sharded, so under DDP only the main process validates. It runs the unwrapped model,
+    # the DDP forward would wait for the other processes to join its buffer broadcast
+    val_model = _unwrap_model(model) if args.distributed else model
+
+    # set on the first best epoch, stays None if no epoch produced a comparable c-index
+    best_metrics = None
     
     for epoch in range(args.max_epochs):
-        _train_loop_survival(args, epoch, model, args.omics_format, train_loader, optimizer, loss_fn, log_file)
-        results_dict, val_cindex, val_cindex_ipcw, val_BS, val_IBS, val_iauc, total_loss = _summary(args.dataset_factory,
-        model, args.omics_format, val_loader, loss_fn, all_survival,args.miss)
-        print(
-            'Epoch:{} Val c-index: {:.4f} | Final Val c-index2: {:.4f} | Final Val IBS: {:.4f} | Final Val iauc: {:.4f}'.format(
-                epoch,
-                val_cindex,
-                val_cindex_ipcw,
-                val_IBS,
-                val_iauc
-            ))
-        log_file.write(
-            'Epoch:{} Val c-index: {:.4f} | Final Val c-index2: {:.4f} | Final Val IBS: {:.4f} | Final Val iauc: {:.4f}\n'.format(
-                epoch,
-                val_cindex,
-                val_cindex_ipcw,
-                val_IBS,
-                val_iauc
-            ))
+        _train_loop_survival(args, epoch, model, args.omics_format, train_loader, optimizer, loss_fn, log_file, scaler)
+        if not _is_main_process():
+            continue
+
+        results_dict, all_risk_scores, all_censorships, all_event_times, all_risk_by_bin_scores, total_loss = _summary_forward(
+            val_model, args.omics_format, val_loader, loss_fn, args.miss, args.amp, args.channels_last)
+        val_cindex = _calculate_cindex(all_risk_scores, all_censorships, all_event_times)
+
+        # the sksurv metrics are expensive, only compute them for a new best epoch and for the last one
+        if val_cindex >= args.max_cindex or epoch == args.max_epochs - 1:
+            val_cindex, val_cindex_ipcw, val_BS, val_IBS, val_iauc = _calculate_metrics(val_loader, args.dataset_factory,
+            all_survival, all_risk_scores, all_censorships, all_event_times, all_risk_by_bin_scores)
+            print(
+                'Epoch:{} Val c-index: {:.4f} | Final Val c-index2: {:.4f} | Final Val IBS: {:.4f} | Final Val iauc: {:.4f}'.format(
+                    epoch,
+                    val_cindex,
+                    val_cindex_ipcw,
+                    val_IBS,
+                    val_iauc
+                ))
+            log_file.write(
+                'Epoch:{} Val c-index: {:.4f} | Final Val c-index2: {:.4f} | Final Val IBS: {:.4f} | Final Val iauc: {:.4f}\n'.format(
+                    epoch,
+                    val_cindex,
+                    val_cindex_ipcw,
+                    val_IBS,
+                    val_iauc
+                ))
+        else:
+            print('Epoch:{} Val c-index: {:.4f}'.format(epoch, val_cindex))
+            log_file.write('Epoch:{} Val c-index: {:.4f}\n'.format(epoch, val_cindex))
+
         if val_cindex >= args.max_cindex:
             args.max_cindex = val_cindex
             args.max_cindex_epoch = epoch
-            torch.save(model.state_dict(), os.path.join(args.results_dir, "model_best_s{}.pth".format(cur)))
+            # keep the metrics of the best epoch, so the best checkpoint does not need to be validated again
+            best_metrics = (val_cindex_ipcw, val_BS, val_IBS, val_iauc, total_loss)
+            torch.save(_unwrap_model(model).state_dict(), os.path.join(args.results_dir, "model_best_s{}.pth".format(cur)))
             _save_results(cur, results_dict, args)
 
+    if not _is_main_process():
+        # the other DDP processes only train, the results are reported by the main process
+        return None, (None, None, None, None, None, None)
+
+    if best_metrics is None:
+        raise RuntimeError('No epoch produced a valid val c-index (max_epochs = {}), there is no best model to report'.format(args.max_epochs))
     
     # save the trained model
-    torch.save(model.state_dict(), os.path.join(args.results_dir, "s_{}_checkpoint.pth".format(cur)))
-    
-    results_dict, val_cindex, val_cindex_ipcw, val_BS, val_IBS, val_iauc, total_loss = _summary(args.dataset_factory, model, args.omics_format, val_loader, loss_fn, all_survival)
+    torch.save(_unwrap_model(model).state_dict(), os.path.join(args.results_dir, "s_{}_checkpoint.pth".format(cur)))
     
+    if args.miss is not None:
+        # the epochs were validated with a missing modality, the trained model is reported with both modalities
+        results_dict, val_cindex, val_cindex_ipcw, val_BS, val_IBS, val_iauc, total_loss = _summary(args.dataset_factory,
+        val_model, args.omics_format, val_loader, loss_fn, all_survival, amp=args.amp, channels_last=args.channels_last)
+    # otherwise the last epoch was fully evaluated in the loop, results_dict and the metrics are those of the trained model
     print('Final Val c-index: {:.4f} | Final Val c-index2: {:.4f} | Final Val IBS: {:.4f} | Final Val iauc: {:.4f}'.format(
         val_cindex, 
         val_cindex_ipcw,
@@ -691,9 +1020,15 @@ def _step(cur, args, loss_fn, model, optimizer, train_loader, val_loader, log_fi
         val_iauc
         ))
 
-    best_model = torch.load(os.path.join(args.results_dir, "model_best_s{}.pth".format(cur)))
-    model.load_state_dict(best_model)
-    _, val_cindex, val_cindex_ipcw, val_BS, val_IBS, val_iauc, total_loss = _summary(args.dataset_factory, model, args.omics_format, val_loader, loss_fn, all_survival)
+    if args.miss is not None:
+        # same for the best model, its checkpoint is validated again with both modalities
+        best_model = torch.load(os.path.join(args.results_dir, "model_best_s{}.pth".format(cur)), map_location=args.device)
+        _unwrap_model(model).load_state_dict(best_model)
+        _, val_cindex, val_cindex_ipcw, val_BS, val_IBS, val_iauc, total_loss = _summary(args.dataset_factory,
+        val_model, args.omics_format, val_loader, loss_fn, all_survival, amp=args.amp, channels_last=args.channels_last)
+    else:
+        val_cindex = args.max_cindex
+        val_cindex_ipcw, val_BS, val_IBS, val_iauc, total_loss = best_metrics
     print('Best Val c-index: {:.4f} | Best Val c-index2: {:.4f} | Best Val IBS: {:.4f} | Best Val iauc: {:.4f}'.format(
         val_cindex,
         val_cindex_ipcw,
@@ -2,11 +2,48 @@ import os
 import pandas as pd 
 
 import torch
+import torch.distributed as dist
 import numpy as np
 
 from torch.utils.data import DataLoader, Sampler, WeightedRandomSampler, RandomSampler, SequentialSampler, sampler
 
 
+def _init_distributed(args):
+    r"""
+    Reads the torchrun environment and, when more than one process is launched, joins the NCCL process group
+    with one GPU per process.
+
+    Args:
+        - args : argparse.Namespace
+
+    Returns:
+        - args : argparse.Namespace
+
+    """
+    args.world_size = int(os.environ.get("WORLD_SIZE", 1))
+    args.local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    args.distributed = args.world_size > 1
+
+    if args.distributed:
+        torch.cuda.set_device(args.local_rank)
+        dist.init_process_group(backend="nccl")
+
+    return args
+
+def _is_main_process():
+    r"""
+    Whether this process should write logs, checkpoints and results (always True without DDP)
+
+    Args:
+        - None
+
+    Returns:
+        - Boolean
+
+    """
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
 def _prepare_for_experiment(args):
     r"""
     Creates experiment code which will be used for identifying the experiment later on. Uses the experiment code to make results dir.
@@ -57,7 +94,8 @@ def _prepare_for_experiment(args):
         # ---> where to stroe the experiment related assets
         _create_results_dir(args)
         # ---> bookkeping
-        _print_and_log_experiment(args, settings)
+        if _is_main_process():
+            _print_and_log_experiment(args, settings)
     else:
         _reading_experiment_settings(args)
 
@@ -206,7 +244,7 @@ def _create_results_dir(args):
     """
     args.results_dir = os.path.join(args.results_dir) # create an experiment specific subdir in the results dir
     if not os.path.isdir(args.results_dir):
-        os.mkdir(args.results_dir)
+        os.makedirs(args.results_dir, exist_ok=True) # other DDP processes may create it at the same time
         #---> add gitignore to results dir
         f = open(os.path.join(args.results_dir, ".gitignore"), "w")
         f.write("*\n")
@@ -217,7 +255,7 @@ def _create_results_dir(args):
     #---> results for this specific experiment
     args.results_dir = os.path.join(args.results_dir, args.param_code)
     if not os.path.isdir(args.results_dir):
-        os.mkdir(args.results_dir)
+        os.makedirs(args.results_dir, exist_ok=True)
 
 def _get_start_end(args):
     r"""
@@ -438,20 +476,20 @@ def _collate_survpath(batch):
     
     Returns:
         - img : torch.Tensor 
-        - omic_data_list : List
+        - omic_data_list : List of torch.FloatTensor, one per pathway
         - label : torch.LongTensor 
         - event_time : torch.FloatTensor 
         - c : torch.FloatTensor 
         - clinical_data_list : List
-        - mask : torch.Tensor
+        - mask : torch.Tensor or None
         
     """
     
     img = torch.stack([item[0] for item in batch])
 
-    omic_data_list = []
-    for item in batch:
-        omic_data_list.append(item[1])
+    # one (batch_size, omic_size) tensor per pathway, so each group is a single H2D copy
+    num_pathways = len(batch[0][1])
+    omic_data_list = [torch.stack([item[1][i] for item in batch], dim=0).type(torch.FloatTensor) for i in range(num_pathways)]
 
     label = torch.LongTensor([item[2].long() for item in batch])
     event_time = torch.FloatTensor([item[3] for item in batch])
@@ -462,6 +500,9 @@ def _collate_survpath(batch):
         clinical_data_list.append(item[5])
 
     mask = torch.stack([item[6] for item in batch], dim=0)
+    # unsampled (validation) bags carry a mask of ones, decide it here on the cpu rather than on the copied GPU tensor
+    if mask[0, 0] == 1:
+        mask = None
 
     return [img, omic_data_list, label, event_time, c, clinical_data_list, mask]
 
@@ -503,7 +544,7 @@ class SubsetSequentialSampler(Sampler):
 		return len(self.indices)
 
 
-def _get_split_loader(args, split_dataset, training = False, testing = False, weighted = False, batch_size=1):
+def _get_split_loader(args, split_dataset, training = False, testing = False, weighted = False, batch_size=1, sampler=None):
     r"""
     Take a dataset and make a dataloader from it using a custom collate function. 
 
@@ -514,13 +555,21 @@ def _get_split_loader(args, split_dataset, training = False, testing = False, we
         - testing : Boolean
         - weighted : Boolean 
         - batch_size : Int 
+        - sampler : Sampler, overrides the training sampler (e.g. DistributedSampler)
     
     Returns:
         - loader : Pytorch Dataloader 
     
     """
 
-    kwargs = {'num_workers': 0} if args.device.type == "cuda" else {}
+    kwargs = {'num_workers': args.num_workers}
+    if args.device.type == "cuda":
+        # pinned host memory lets the H2D copies in _unpack_data run with non_blocking=True
+        # freed pinned blocks are recycled by PyTorch's caching host allocator, so cudaHostAlloc is not called per batch
+        kwargs['pin_memory'] = True
+    if args.num_workers > 0:
+        kwargs['persistent_workers'] = True
+        kwargs['prefetch_factor'] = 4
     
     if args.omics_format == "gene":
         collate_fn = _collate_omics
@@ -533,7 +582,9 @@ def _get_split_loader(args, split_dataset, training = False, testing = False, we
 
     if not testing:
         if training:
-            if weighted:
+            if sampler is not None:
+                loader = DataLoader(split_dataset, batch_size=batch_size, sampler = sampler, collate_fn = collate_fn, drop_last=False, **kwargs)
+            elif weighted:
                 weights = _make_weights_for_balanced_classes_split(split_dataset)
                 loader = DataLoader(split_dataset, batch_size=batch_size, sampler = WeightedRandomSampler(weights, len(weights)), collate_fn = collate_fn, drop_last=False, **kwargs)
             else:
@@ -47,11 +47,17 @@ def _process_args():
     parser.add_argument('--reg_type', type=str, default="None", help="regularization type [None, L1, L2]")
     parser.add_argument('--weighted_sample', action='store_false', default=True, help='enable weighted sampling')
     parser.add_argument('--batch_size', type=int, default=32, help='batch_size')
+    parser.add_argument('--num_workers', type=int, default=0, help='number of dataloader workers')
+    parser.add_argument('--accum_steps', type=int, default=1, help='number of batches to accumulate gradients over before each optimizer step')
+    parser.add_argument('--log_interval', type=int, default=50, help='print the training loss every log_interval batches')
     parser.add_argument('--bag_loss', type=str, choices=["nll_surv", "rank_surv", "cox_surv"], default='nll_surv',
                         help='survival loss function (default: ce)')
     parser.add_argument('--alpha_surv', type=float, default=0.5, help='weight given to uncensored patients')
     parser.add_argument('--reg', type=float, default=1e-3, help='weight decay / L2 (default: 1e-5)')
     parser.add_argument('--max_cindex', type=float, default=0.0, help='maximum c-index')
+    parser.add_argument('--amp', action='store_true', default=False, help='train and validate with bfloat16 autocast')
+    parser.add_argument('--channels_last', action='store_true', default=False, help='use channels_last memory format for 4D WSI inputs')
+    parser.add_argument('--compile', action='store_true', default=False, help='compile the model with torch.compile (torch >= 2.0)')
 
     #---> model related
     parser.add_argument('--method', type=str, default="PIBD", help='methd type')
@@ -78,4 +84,9 @@ def _process_args():
         print("Task and folder does not match")
         exit()
 
+    if args.accum_steps < 1:
+        parser.error("--accum_steps must be at least 1")
+    if args.log_interval < 1:
+        parser.error("--log_interval must be at least 1")
+
     return args
@@ -9,12 +9,12 @@
 
 import torch
 import os
-from utils.core_utils import _get_splits,_init_model, _init_loaders, _extract_survival_metadata, _init_loss_function, _summary
+from utils.core_utils import _get_splits,_init_model, _init_loaders, _extract_survival_metadata, _init_loss_function, _summary, _unwrap_model
 
 
 def _get_val_results(args,model,train_loader,val_loader,log_file,loss_fn):
     all_survival = _extract_survival_metadata(train_loader, val_loader)
-    _, val_cindex, val_cindex_ipcw, val_BS, val_IBS, val_iauc, total_loss = _summary(args.dataset_factory, model, args.omics_format, val_loader, loss_fn, all_survival)
+    _, val_cindex, val_cindex_ipcw, val_BS, val_IBS, val_iauc, total_loss = _summary(args.dataset_factory, model, args.omics_format, val_loader, loss_fn, all_survival, amp=args.amp, channels_last=args.channels_last)
 
     print('Best Val c-index: {:.4f} | Best Val c-index2: {:.4f} | Best Val IBS: {:.4f} | Best Val iauc: {:.4f}'.format(
         val_cindex,
@@ -52,7 +52,7 @@ def _val(datasets,cur,args,log_file):
     # ----> load params of model
 
     path = os.path.join(args.results_dir, "model_best_s{}.pth".format(cur))
-    model.load_state_dict(torch.load(path), strict=True)
+    _unwrap_model(model).load_state_dict(torch.load(path, map_location=args.device), strict=True)
     print("Loaded model from {}".format(path))
     log_file.write("Loaded model from {}\n".format(path))
 